@@ -8,14 +8,48 @@ Modified by: Kevin Kratzer <kevin.kratzer@ghelia.com>
 Modifications Copyright (C) 2019 GHELIA Inc.
 """
 import base64
+import binascii
+import mmap
 import os
+import queue
+import re
+import string
+import threading
 import time
-from typing import List, Optional, Union
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 
 import serial
 
+try:
+    # Optional SIMD accelerated base64 implementation
+    from pybase64 import b64encode as _b64encode
+except ImportError:
+    _b64encode = base64.b64encode  # type: ignore[assignment]
+
 UPLOAD_FILE_NAME = '__upload_0c19c2b6e0a34223afe5b.py'
 
+# Chunks of 1024 encoded bytes correspond to 768 bytes of input data
+_CHUNK_SIZE = 768
+_EN_CHUNK_SIZE = 1024
+# Number of packets kept in flight before their acks are read
+_WINDOW_SIZE = 8
+# All packets except the tail carry the full encoded chunk length
+_FULL_PACKET_HEADER = b"#" + f"{_EN_CHUNK_SIZE:04d}".encode("ascii")
+# Marks the end of the stream; the device replies with the final status
+_END_PACKET = b"#0000"
+
+# Maps a letter to its control character, e.g. 'c' to ctrl+c
+_CONTROL_CHARACTERS = {letter: chr(ord(letter) - 0x60) for letter in string.ascii_lowercase}
+
+
+def _crc_suffix(en_chunk: bytes) -> bytes:
+    # The CRC travels over the REPL stdin, so it is sent as hex digits
+    # instead of raw bytes which could contain control characters
+    return f"{binascii.crc32(en_chunk):08x}".encode("ascii")
+
+
+_Window = Tuple[int, List[bytes]]
+
 
 class SerialTransmitter:
     """
@@ -27,11 +61,18 @@ class SerialTransmitter:
 
     Args:
         port (str): The serial port on which the controller can be accessed
+        pacing_delay (float): Base delay in seconds inserted after each write
+            to the REPL. Defaults to 0, relying on the device acks and paste
+            mode echo for pacing; set a small value (e.g. 0.03) for links
+            which lose data without artificial pacing
     """
-    def __init__(self, port: str):
+    # Source of the upload helper script, shared between sessions
+    __upload_helper_source: Optional[str] = None
+
+    def __init__(self, port: str, pacing_delay: float = 0.0):
         self.__port: str = port
         self.__serial_connection: Optional[serial.Serial] = None
-        self.__base_send_delay: float = 0.03
+        self.__pacing_delay: float = pacing_delay
 
     def __enter__(self):
         self.__serial_connection = SerialTransmitter.__open_serial_connection(self.__port)
@@ -56,7 +97,7 @@ class SerialTransmitter:
 
     @staticmethod
     def __open_serial_connection(port: str) -> serial.Serial:
-        serial_connection = serial.Serial(None, 115200, timeout=0, write_timeout=0.2)
+        serial_connection = serial.Serial(None, 115200, timeout=0, write_timeout=None)
         serial_connection.dtr = False
         serial_connection.rts = True
         serial_connection.port = port
@@ -65,16 +106,20 @@ class SerialTransmitter:
         serial_connection.rts = False
         return serial_connection
 
-    def create_file(self, content: bytes, file_name: str):
+    def create_file(self, content: Union[bytes, mmap.mmap, Iterable[bytes]], file_name: str):
         """
         Create a file from an utf-8 encoded data buffer
         Args:
-            content (byte): utf-8 encoded data which will be stored in the file
+            content (bytes): utf-8 encoded data which will be stored in the file,
+                either as a bytes-like object or as an iterable of byte blocks
             file_name (str): The filename for the newly created file on the controller
         """
         self.run_file(UPLOAD_FILE_NAME, "file_name=\"{}\"".format(file_name))
         self._flush_input()
-        self._send_file(content)
+        if isinstance(content, (bytes, bytearray, mmap.mmap)):
+            self._send_file(content)
+        else:
+            self._send_stream(content)
 
     def upload(self, file_path: str):
         """
@@ -84,7 +129,17 @@ class SerialTransmitter:
         """
         file_name = os.path.basename(file_path)
         with open(file_path, 'rb') as source:
-            self.create_file(source.read(), file_name)
+            try:
+                # Let the OS page the file in on demand instead of
+                # keeping a full in-memory copy
+                mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty or unmappable file, stream it in chunk sized blocks
+                # so peak memory stays constant
+                self.create_file(iter(lambda: source.read(_CHUNK_SIZE), b""), file_name)
+            else:
+                with mapped:
+                    self.create_file(mapped, file_name)
 
     def run_file(self, file_name: str, globals_init: str = ""):
         """
@@ -93,11 +148,13 @@ class SerialTransmitter:
             file_name (str): The file name to be executed which is stored on the controller
             globals_init (str): Initializier prior to script execution
         """
-        self._send_start_paste()
+        lines = []
         if globals_init:
-            self._send_line(globals_init, "\r")
-        self._send_line("with open(\"{}\") as f:".format(file_name))
-        self._send_line("    exec(f.read(), globals())")
+            lines.append(globals_init)
+        lines.append("with open(\"{}\") as f:".format(file_name))
+        lines.append("    exec(f.read(), globals())")
+        self._send_start_paste()
+        self._send_block(lines)
         self._send_end_paste()
 
     def send_control_character(self, character: str):
@@ -106,119 +163,263 @@ class SerialTransmitter:
         Args:
             character (str): The control character e.g. c for ctrl+c
         """
-        self._send_character(chr(ord(character) - ord("a") + 1))
+        self._send_character(_CONTROL_CHARACTERS[character.lower()])
+
+    def _send_file(self, data: Union[bytes, mmap.mmap]):
+        # Encode the whole buffer in one pass to prevent special REPL sequences
+        encoded = _b64encode(data)
+        windows = SerialTransmitter.__frame_windows(encoded)
+        # Small transfers are not worth a writer thread
+        if len(encoded) <= _WINDOW_SIZE * _EN_CHUNK_SIZE:
+            for window in windows:
+                self.__send_window(window, data)
+        else:
+            self.__send_windows_threaded(windows, data)
+
+    def _send_stream(self, reader: Iterable[bytes]):
+        self.__send_windows_threaded(SerialTransmitter.__frame_stream_windows(reader), None)
 
-    def _send_file(self, data: bytes):
-        serial_connection = self._serial_connection
-        # Split data into smaller chunks
-        idx = 0
-        # Using chunks of 48 bytes, encoded chunk should be at most 64 bytes
-        chunk_size = 48
-        total_len = len(data)
-        while idx < total_len:
-            chunk = data[idx:idx + chunk_size]
-            # Encode data to prevent special REPL sequences
-            en_chunk = base64.b64encode(chunk)
-            serial_connection.write(
-                b"".join([b"#", str(len(en_chunk)).zfill(2).encode("ascii"), en_chunk]))
-            ack = self._read_with_timeout(2)
+    @staticmethod
+    def __frame_stream_windows(reader: Iterable[bytes]) -> Iterator[_Window]:
+        window_start = 0
+        window: List[bytes] = []
+        pending = bytearray()
+        for block in reader:
+            pending.extend(block)
+            # The chunk size is a multiple of 3, so chunks encoded
+            # separately concatenate to the encoding of the whole stream
+            while len(pending) >= _CHUNK_SIZE:
+                en_chunk = _b64encode(bytes(pending[:_CHUNK_SIZE]))
+                del pending[:_CHUNK_SIZE]
+                window.append(_FULL_PACKET_HEADER + en_chunk + _crc_suffix(en_chunk))
+                if len(window) == _WINDOW_SIZE:
+                    yield window_start, window
+                    window_start += len(window)
+                    window = []
+        if pending:
+            tail = _b64encode(bytes(pending))
+            window.append(b"#" + f"{len(tail):04d}".encode("ascii") + tail + _crc_suffix(tail))
+        window.append(_END_PACKET)
+        yield window_start, window
 
+    @staticmethod
+    def __frame_windows(encoded: bytes) -> Iterator[_Window]:
+        total_len = len(encoded)
+        window_start = 0
+        window: List[bytes] = []
+        if total_len:
+            tail_start = (total_len - 1) // _EN_CHUNK_SIZE * _EN_CHUNK_SIZE
+            for idx in range(0, total_len, _EN_CHUNK_SIZE):
+                if idx < tail_start:
+                    en_chunk = encoded[idx:idx + _EN_CHUNK_SIZE]
+                    window.append(_FULL_PACKET_HEADER + en_chunk + _crc_suffix(en_chunk))
+                else:
+                    tail = encoded[tail_start:]
+                    window.append(b"#" + f"{len(tail):04d}".encode("ascii")
+                                  + tail + _crc_suffix(tail))
+                if len(window) == _WINDOW_SIZE:
+                    yield window_start, window
+                    window_start += len(window)
+                    window = []
+        # The end marker rides in the last window, so the device can flush
+        # its batched acks together with the final status reply
+        window.append(_END_PACKET)
+        yield window_start, window
+
+    def __send_window(self, window: _Window, data: Optional[Union[bytes, mmap.mmap]]):
+        serial_connection = self._serial_connection
+        window_start, packets = window
+        # Keep the whole window in flight instead of stop-and-wait,
+        # so throughput is bound by the baud rate rather than the ack round-trip
+        for packet in packets:
+            serial_connection.write(packet)
+        acks = self._read_with_timeout(2 * len(packets))
+        for offset, packet in enumerate(packets):
+            ack = acks[offset * 2:offset * 2 + 2]
+            if packet == _END_PACKET:
+                # Check the final status reply
+                if len(ack) < 2:
+                    raise ConnectionError("Device failed to respond in specified timeout.")
+                if ack != b"#0":
+                    raise ConnectionError(
+                        "Error in protocol. Expected #0 but device replied with: {}."
+                        .format(ack.decode(errors='ignore')))
+                continue
             error = None
-            if not ack:
+            if len(ack) < 2:
                 error = "Device failed to respond in specified timeout."
             elif ack == b"#2":
                 error = "Device didn't receive next message in time or message header corrupt."
             elif ack == b"#3":
-                error = "Device didn't receive as much data as was indicated in the message header."
+                error = ("Device didn't receive as much data as was indicated "
+                         "in the message header.")
+            elif ack == b"#5":
+                error = "Device reported a checksum mismatch for the message."
             elif ack != b"#1":
                 error = "Error in protocol. Expected #1 but device replied with:\n{}.".format(
                     ack.decode(errors='ignore'))
 
             if error:
-                error += "\n\nLast message was:\n{}.".format(chunk.decode(errors='ignore'))
+                if data is not None:
+                    chunk_index = window_start + offset
+                    chunk = data[chunk_index * _CHUNK_SIZE:(chunk_index + 1) * _CHUNK_SIZE]
+                    error += "\n\nLast message was:\n{}.".format(
+                        bytes(chunk).decode(errors='ignore'))
                 raise ConnectionError(error)
 
-            idx += len(chunk)
-
-        # Mark end and check for success
-        serial_connection.write(b"#00")
-        check = self._read_with_timeout(2)
-
-        if not check:
-            raise ConnectionError("Device failed to respond in specified timeout.")
-        if check != b"#0":
-            raise ConnectionError("Error in protocol. Expected #0 but device replied with: {}."
-                                  .format(check.decode(errors='ignore')))
-
-    def _read_with_timeout(self, count: int, timeout_s: float = 2.0) -> Optional[bytes]:
+    def __send_windows_threaded(self, windows: Iterator[_Window],
+                                data: Optional[Union[bytes, mmap.mmap]]):
+        # Overlap framing of the upcoming windows with the serial transfer
+        window_queue: 'queue.Queue[Optional[_Window]]' = queue.Queue(maxsize=16)
+        failure: List[Exception] = []
+
+        def send_queued_windows():
+            while True:
+                window = window_queue.get()
+                if window is None:
+                    return
+                if failure:
+                    # Keep draining so the producer never blocks on a full queue
+                    continue
+                try:
+                    self.__send_window(window, data)
+                except Exception as error:  # pylint: disable=broad-except
+                    # Anything escaping here (e.g. SerialException on
+                    # disconnect) would otherwise kill the thread unnoticed
+                    failure.append(error)
+
+        writer = threading.Thread(target=send_queued_windows, daemon=True)
+        writer.start()
+        try:
+            for window in windows:
+                if failure:
+                    break
+                window_queue.put(window)
+        finally:
+            window_queue.put(None)
+            writer.join()
+        if failure:
+            raise failure[0]
+
+    def _read_with_timeout(self, count: int, timeout_s: float = 2.0) -> bytes:
         serial_connection = self._serial_connection
-        period = 0.005
-        data = bytearray()
-        for _ in range(0, int(timeout_s / period)):
-            rec = serial_connection.read(count - len(data))
-            if rec:
-                data.extend(rec)
-                if len(data) == count:
-                    return bytes(data)
-            time.sleep(period)
-
-        return None
+        # Let pyserial block inside the OS read instead of polling with a sleep,
+        # restoring the non-blocking mode the rest of the class relies on afterwards
+        serial_connection.timeout = timeout_s
+        try:
+            data = serial_connection.read(count)
+        finally:
+            serial_connection.timeout = 0
+
+        # On timeout whatever arrived so far is returned,
+        # so callers can report the partial reply
+        return data
 
     def _flush_input(self):
         serial_connection = self._serial_connection
-        while serial_connection.read(100):
-            pass
+        serial_connection.reset_input_buffer()
+        # Without per-write pacing the device echo may still be in flight,
+        # so keep discarding until the line has been quiet for a short while
+        serial_connection.timeout = 0.02
+        try:
+            while serial_connection.read(256):
+                pass
+        finally:
+            serial_connection.timeout = 0
+
+    @classmethod
+    def __read_upload_helper(cls) -> str:
+        if cls.__upload_helper_source is None:
+            file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'upload.py')
+            with open(file_path, encoding='utf-8') as source:
+                cls.__upload_helper_source = source.read()
+        return cls.__upload_helper_source
 
     def __send_upload_file(self):
-        file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'upload.py')
-        with open(file_path, encoding='utf-8') as source:
-            data = source.read()
-            data = data.replace("file_name.py", UPLOAD_FILE_NAME)
-            self.__paste_lines(data.split("\n"))
-        with open(file_path, encoding='utf-8') as source:
-            self._send_file(source.read().replace('"file_name.py"', 'file_name').encode('utf-8'))
+        raw = SerialTransmitter.__read_upload_helper()
+        helper = raw.replace('"file_name.py"', 'file_name').encode('utf-8')
+        if self.__helper_size_on_device() == len(helper):
+            # Helper left over from a session which did not clean up,
+            # no need to transfer it again
+            return
+        self.__paste_lines(raw.replace("file_name.py", UPLOAD_FILE_NAME).split("\n"))
+        self._send_file(helper)
+
+    def __helper_size_on_device(self) -> int:
+        self._flush_input()
+        self._send_start_paste()
+        # Assemble the marker at runtime so the paste mode echo cannot match it
+        self._send_block([
+            'import os',
+            'try:',
+            '    print("#" + "S%d" % os.stat("{}")[6])'.format(UPLOAD_FILE_NAME),
+            'except OSError:',
+            '    print("#" + "S" + "-1")',
+        ])
+        self._send_end_paste()
+        try:
+            response = self._read_to_next_prompt(2)
+        except TimeoutError:
+            return -1
+        match = re.search(r"#S(-?\d+)", response)
+        return int(match.group(1)) if match else -1
 
     def __remove_upload_file(self):
         self.__paste_lines(['import os', f'os.remove("{UPLOAD_FILE_NAME}")'])
 
     def __paste_lines(self, lines: List[str]):
         self._send_start_paste()
-        for line in lines:
-            self._send_line(line, "\r")
+        self._send_block(lines)
         self._send_end_paste()
         self._flush_input()
 
     def _get_send_delay(self, transmitted_content: Union[str, bytes]) -> float:
+        if not self.__pacing_delay:
+            return 0
         return min(1, max(
-            self.__base_send_delay,
-            (len(transmitted_content) >> 6)*self.__base_send_delay))
+            self.__pacing_delay,
+            (len(transmitted_content) >> 6)*self.__pacing_delay))
+
+    def _send_block(self, lines: List[str]):
+        serial_connection = self._serial_connection
+        block = ("\r".join(lines) + "\r").encode('utf-8')
+        serial_connection.write(block)
+        delay = self._get_send_delay(block)
+        if delay:
+            time.sleep(delay)
 
     def _send_line(self, line_text: str, ending: str = "\r\n"):
         assert isinstance(line_text, str)
         assert isinstance(ending, str)
         serial_connection = self._serial_connection
         serial_connection.write((line_text + ending).encode('utf-8'))
-        serial_connection.flush()
-        time.sleep(self._get_send_delay(line_text))
+        delay = self._get_send_delay(line_text)
+        if delay:
+            time.sleep(delay)
 
     def _send_character(self, char: str):
         assert isinstance(char, str)
 
         self._serial_connection.write(char.encode('utf-8'))
-        time.sleep(self._get_send_delay(char))
+        delay = self._get_send_delay(char)
+        if delay:
+            time.sleep(delay)
 
     def _send_start_paste(self):
         self._send_character("\5")
 
     def _send_end_paste(self):
         self._send_character("\4")
+        # Drain the OS write buffer before waiting for the device reply
+        self._serial_connection.flush()
 
     def _read_to_next_prompt(self, timeout: float = 5.0):
         serial_connection = self._serial_connection
-        received_data = b""
-        start_time = time.time()
-        while len(received_data) < 4 or received_data[-4:] != b">>> ":
-            if (time.time() - start_time) >= timeout:
-                raise TimeoutError()
-            received_data += serial_connection.read(1)
+        serial_connection.timeout = timeout
+        try:
+            received_data = serial_connection.read_until(b">>> ")
+        finally:
+            serial_connection.timeout = 0
+        if not received_data.endswith(b">>> "):
+            raise TimeoutError()
         return received_data.decode("utf-8", errors="replace")
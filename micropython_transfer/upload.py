@@ -11,7 +11,7 @@ Modifications Copyright (C) 2019 GHELIA Inc.
 import sys
 import time
 
-from ubinascii import a2b_base64
+from ubinascii import a2b_base64, crc32
 
 
 def _read_timeout(cnt, timeout_ms=2000):
@@ -25,24 +25,41 @@ def _read_timeout(cnt, timeout_ms=2000):
 
 def _upload():
     suc = False
+    # Batch acks and flush once per window of 8 messages,
+    # matching the window size of the transmitting host
+    acks = ""
+    # Collect decoded data up to a flash page before writing it out
+    buf = bytearray()
     with open("file_name.py", "wb") as target_file:
         while True:
-            received_data = _read_timeout(3)
+            received_data = _read_timeout(5)
             if not received_data or received_data[0] != "#":
-                sys.stdout.write("#2")
+                acks += "#2"
                 break
-            cnt = int(received_data[1:3])
+            cnt = int(received_data[1:5])
             if cnt == 0:
                 suc = True
                 break
             received_data = _read_timeout(cnt)
-            if received_data:
-                target_file.write(a2b_base64(received_data))
-                sys.stdout.write("#1")
+            crc = _read_timeout(8)
+            if received_data and crc:
+                if int(crc, 16) != crc32(received_data.encode()):
+                    acks += "#5"
+                    break
+                buf.extend(a2b_base64(received_data))
+                if len(buf) >= 4096:
+                    target_file.write(buf)
+                    buf = bytearray()
+                acks += "#1"
+                if len(acks) >= 16:
+                    sys.stdout.write(acks)
+                    acks = ""
             else:
-                sys.stdout.write("#3")
+                acks += "#3"
                 break
-    sys.stdout.write("#0" if suc else "#4")
+        if buf:
+            target_file.write(buf)
+    sys.stdout.write(acks + ("#0" if suc else "#4"))
 
 
 _upload()
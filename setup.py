@@ -24,5 +24,8 @@ setup(
     install_requires=[
         'pyserial==3.4'
     ],
+    extras_require={
+        'fast': ['pybase64']
+    },
     packages=['micropython_transfer']
 )